@@ -7,33 +7,167 @@ AI Processing Pipeline for Educational Video Generator
 - Video Assembly (FFmpeg)
 """
 
+import importlib.util
+import os
+
+# Use the persistent /models cache when the deployment provides one; must be set before the HF libraries are imported
+if os.path.isdir("/models") and os.access("/models", os.W_OK):
+    os.environ.setdefault("HF_HOME", "/models")
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 from transformers import pipeline as hf_pipeline, AutoTokenizer, AutoModelForCausalLM
-import requests
-from diffusers import StableDiffusionPipeline
+import httpx
+import aiofiles
+from diffusers import StableDiffusionXLPipeline, DPMSolverMultistepScheduler
+import torch
+import asyncio
+import functools
+import itertools
+import logging
+import re
 import subprocess
-import os
 import uuid
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Literal
+
+logger = logging.getLogger(__name__)
+
+def _from_pretrained(cls, model_id: str, **kwargs):
+    """Load from the local HF cache when the weights are already there, downloading only on a miss."""
+    try:
+        return cls.from_pretrained(model_id, local_files_only=True, **kwargs)
+    except OSError:
+        return cls.from_pretrained(model_id, **kwargs)
 
 # --- Text Enhancement ---
+@functools.lru_cache(maxsize=2)
+def _get_generator(model_name: str):
+    """Load the tokenizer/model once per model name and reuse the text-generation pipeline."""
+    tokenizer = _from_pretrained(AutoTokenizer, model_name)
+    # Batched generation needs a pad token, and decoder-only models must be padded on the left
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    # fp16 only pays off on GPU; on CPU it is slow or unsupported, so keep fp32 there
+    dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+    model = _from_pretrained(AutoModelForCausalLM, model_name, torch_dtype=dtype, device_map="auto", use_safetensors=True)
+    return hf_pipeline("text-generation", model=model, tokenizer=tokenizer)
+
+def warmup_text_model(model_name: str = "gpt2") -> None:
+    """Load the text-generation model so the first request doesn't pay for it."""
+    _get_generator(model_name)
+
 def enhance_text(input_text: str, model_name: str = "gpt2") -> str:
     """Enhance educational text using GPT-2 or Llama."""
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForCausalLM.from_pretrained(model_name)
-    generator = hf_pipeline("text-generation", model=model, tokenizer=tokenizer)
+    generator = _get_generator(model_name)
     result = generator(input_text, max_length=512, num_return_sequences=1)
     return result[0]['generated_text']
 
+# Requests arriving within this window are coalesced into one generate() call
+_ENHANCE_MAX_BATCH = 8
+_ENHANCE_MAX_WAIT = 0.02
+_ENHANCE_MAX_NEW_TOKENS = 256
+_enhance_queue: asyncio.Queue = None
+_enhance_worker_task: asyncio.Task = None
+_enhance_loop: asyncio.AbstractEventLoop = None
+
+def _enhance_batch(texts: List[str], model_name: str = "gpt2") -> List[str]:
+    """Enhance several texts with a single padded forward pass."""
+    generator = _get_generator(model_name)
+    tokenizer, model = generator.tokenizer, generator.model
+    # Leave room for the new tokens within the model's context, so one long text can't fail the whole batch
+    max_input_length = model.config.max_position_embeddings - _ENHANCE_MAX_NEW_TOKENS
+    inputs = tokenizer(texts, padding=True, truncation=True, max_length=max_input_length, return_tensors="pt").to(model.device)
+    outputs = model.generate(**inputs, max_new_tokens=_ENHANCE_MAX_NEW_TOKENS, pad_token_id=tokenizer.pad_token_id)
+    return tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+async def _drain(queue: asyncio.Queue, max_batch: int, max_wait: float) -> list:
+    """Wait for one queued item, then collect more until the batch is full or max_wait elapses."""
+    loop = asyncio.get_running_loop()
+    items = [await queue.get()]
+    deadline = loop.time() + max_wait
+    while len(items) < max_batch:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            items.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return items
+
+async def _enhance_worker(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await _drain(queue, _ENHANCE_MAX_BATCH, _ENHANCE_MAX_WAIT)
+        texts = [text for text, _ in batch]
+        try:
+            results = await loop.run_in_executor(None, _enhance_batch, texts)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+async def enhance_text_batched(input_text: str) -> str:
+    """Enhance text with GPT-2, batched together with other concurrent requests."""
+    global _enhance_queue, _enhance_worker_task, _enhance_loop
+    loop = asyncio.get_running_loop()
+    # The queue and worker belong to one event loop; rebuild them if that loop has gone away
+    if _enhance_loop is not loop or _enhance_worker_task.done():
+        _enhance_loop = loop
+        _enhance_queue = asyncio.Queue()
+        _enhance_worker_task = loop.create_task(_enhance_worker(_enhance_queue))
+    future = loop.create_future()
+    await _enhance_queue.put((input_text, future))
+    return await future
+
 # --- Text-to-Speech ---
 
 # --- ElevenLabs TTS API ---
-def generate_audio(text: str, voice: str = "Rachel", out_path: str = "output.mp3", speed: float = 1.0, api_key: str = None) -> str:
-    """Generate speech audio from text using ElevenLabs TTS API."""
+def _new_tts_client() -> httpx.AsyncClient:
+    """HTTP/2 client with a bounded connection pool and retries on connection failures."""
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+    )
+    return httpx.AsyncClient(transport=transport, timeout=120)
+
+# Shared client so repeated TTS calls reuse pooled connections instead of a fresh TLS handshake each time
+_tts_client: httpx.AsyncClient = None
+_tts_loop: asyncio.AbstractEventLoop = None
+
+def _get_tts_client() -> httpx.AsyncClient:
+    global _tts_client, _tts_loop
+    loop = asyncio.get_running_loop()
+    # Pooled connections belong to one event loop; rebuild the client if that loop has gone away
+    if _tts_loop is not loop or _tts_client.is_closed:
+        _tts_loop = loop
+        _tts_client = _new_tts_client()
+    return _tts_client
+
+async def close_tts_client() -> None:
+    """Close the shared TTS client's pooled connections, if it was created on the running loop."""
+    global _tts_client, _tts_loop
+    if _tts_client is not None and _tts_loop is asyncio.get_running_loop():
+        await _tts_client.aclose()
+    _tts_client = None
+    _tts_loop = None
+
+async def generate_audio_async(text: str, voice: str = "Rachel", out_path: str = "output.mp3", speed: float = 1.0, api_key: str = None, client: httpx.AsyncClient = None) -> str:
+    """Generate speech audio from text using ElevenLabs TTS API, streaming it to disk."""
     if api_key is None:
         api_key = os.getenv("ELEVENLABS_API_KEY")
     if not api_key:
         raise RuntimeError("ElevenLabs API key not set. Set ELEVENLABS_API_KEY as env variable or pass as argument.")
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice}"
+    if client is None:
+        client = _get_tts_client()
+    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice}/stream"
     headers = {
         "xi-api-key": api_key,
         "Content-Type": "application/json"
@@ -43,74 +177,202 @@ def generate_audio(text: str, voice: str = "Rachel", out_path: str = "output.mp3
         "voice_settings": {"stability": 0.5, "similarity_boost": 0.5, "style": 0.5, "use_speaker_boost": True},
         "model_id": "eleven_multilingual_v2"
     }
-    response = requests.post(url, headers=headers, json=payload)
-    if response.status_code != 200:
-        raise RuntimeError(f"TTS API error: {response.status_code} {response.text}")
-    with open(out_path, "wb") as f:
-        f.write(response.content)
+    async with client.stream("POST", url, headers=headers, json=payload) as response:
+        if response.status_code != 200:
+            await response.aread()
+            raise RuntimeError(f"TTS API error: {response.status_code} {response.text}")
+        async with aiofiles.open(out_path, "wb") as f:
+            async for chunk in response.aiter_bytes(65536):
+                await f.write(chunk)
     return out_path
 
+def generate_audio(text: str, voice: str = "Rachel", out_path: str = "output.mp3", speed: float = 1.0, api_key: str = None) -> str:
+    """Synchronous wrapper around generate_audio_async."""
+    async def _run():
+        # The shared client is bound to the server's event loop, so use a dedicated one here
+        async with _new_tts_client() as client:
+            return await generate_audio_async(text, voice=voice, out_path=out_path, speed=speed, api_key=api_key, client=client)
+    return asyncio.run(_run())
+
 # --- Image Generation ---
-def generate_images(prompts: List[str], out_dir: str, model_id: str = "stabilityai/stable-diffusion-xl-base-1.0") -> List[str]:
+# GPUs with less memory than this run SDXL with model CPU offload instead of fully on-device
+_SD_MIN_VRAM_BYTES = 12 * 1024 ** 3
+# Maximum number of prompts sent through the pipeline in a single batched call
+_SD_BATCH_SIZE = 4
+# Batch size used to warm up the pipeline; the video pipeline generates at most three images
+_SD_WARMUP_BATCH = 3
+# Denoising steps, resolution and guidance per quality tier
+_SD_QUALITY_SETTINGS = {
+    "fast": {"num_inference_steps": 20, "height": 768, "width": 768, "guidance_scale": 6.0},
+    "standard": {"num_inference_steps": 25, "height": 768, "width": 768, "guidance_scale": 6.0},
+    "hq": {"num_inference_steps": 50, "height": 1024, "width": 1024, "guidance_scale": 7.5},
+}
+
+# The cached pipeline (scheduler state, CUDA-graph'd UNet) is not thread-safe, so all SD work runs on one thread
+_sd_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stable-diffusion")
+
+@functools.lru_cache(maxsize=1)
+def _get_sd_pipe(model_id: str):
+    """Load the Stable Diffusion pipeline once, in bf16 (or fp16) on CUDA when available."""
+    if not torch.cuda.is_available():
+        pipe = _from_pretrained(StableDiffusionXLPipeline, model_id, use_safetensors=True)
+        pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+        return pipe
+    dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    pipe = _from_pretrained(StableDiffusionXLPipeline, model_id, torch_dtype=dtype, use_safetensors=True, variant="fp16")
+    # DPM-Solver++ converges in far fewer steps than the default scheduler
+    pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+    if os.getenv("SD_FP8") == "1":
+        # Optional fp8 weight-only quantization of the UNet, requires torchao
+        from torchao.quantization import quantize_, float8_weight_only
+        quantize_(pipe.unet, float8_weight_only())
+    if torch.cuda.get_device_properties(0).total_memory < _SD_MIN_VRAM_BYTES:
+        pipe.enable_model_cpu_offload()
+    else:
+        pipe = pipe.to("cuda")
+        pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=False)
+    pipe.enable_attention_slicing()
+    pipe.enable_vae_tiling()
+    return pipe
+
+def _warmup_sd_pipe(model_id: str) -> None:
+    pipe = _get_sd_pipe(model_id)
+    # Only a torch.compile'd UNet benefits; CPU and CPU-offload pipelines would just delay startup
+    if not hasattr(pipe.unet, "_orig_mod"):
+        return
+    # Graph capture depends on tensor shapes, not step count: real batch size and resolution, two steps
+    settings = {**_SD_QUALITY_SETTINGS["standard"], "num_inference_steps": 2}
+    pipe(["warmup"] * _SD_WARMUP_BATCH, num_images_per_prompt=1, **settings)
+
+def warmup_sd_pipe(model_id: str = "stabilityai/stable-diffusion-xl-base-1.0") -> None:
+    """Load the Stable Diffusion pipeline and, when its UNet is compiled, run it once so it is ready."""
+    # CUDA graphs are per thread, so warm up on the same thread that serves inference
+    try:
+        _sd_executor.submit(_warmup_sd_pipe, model_id).result()
+    except Exception:
+        # Video generation will surface the error itself; the rest of the API should still start
+        logger.exception("Stable Diffusion warmup failed")
+
+def generate_images(prompts: List[str], out_dir: str, model_id: str = "stabilityai/stable-diffusion-xl-base-1.0", quality: Literal["fast", "standard", "hq"] = "standard") -> List[str]:
     """Generate images using Stable Diffusion XL."""
-    pipe = StableDiffusionPipeline.from_pretrained(model_id)
+    pipe = _get_sd_pipe(model_id)
+    settings = _SD_QUALITY_SETTINGS[quality]
     os.makedirs(out_dir, exist_ok=True)
+    # Run prompts through the UNet in batches rather than one diffusion run per prompt
+    images = []
+    for start in range(0, len(prompts), _SD_BATCH_SIZE):
+        batch = prompts[start:start + _SD_BATCH_SIZE]
+        images.extend(pipe(batch, num_images_per_prompt=1, **settings).images)
     image_paths = []
-    for i, prompt in enumerate(prompts):
-        image = pipe(prompt).images[0]
+    for i, image in enumerate(images):
         img_path = os.path.join(out_dir, f"img_{i+1}.png")
         image.save(img_path)
         image_paths.append(img_path)
     return image_paths
 
 # --- Video Assembly ---
+@functools.lru_cache(maxsize=1)
+def _nvenc_available() -> bool:
+    """Check once whether NVENC actually works here, i.e. a CUDA GPU is present and FFmpeg can encode with it."""
+    if not torch.cuda.is_available():
+        logger.info("No CUDA device, encoding videos with libx264")
+        return False
+    # Distro FFmpeg builds list h264_nvenc even without a driver, so encode one real frame.
+    # NVENC rejects frames below a minimum width (often 145px), so probe at a realistic size.
+    probe_cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", "nullsrc=s=256x256",
+        "-frames:v", "1", "-c:v", "h264_nvenc", "-f", "null", "-"
+    ]
+    try:
+        subprocess.run(probe_cmd, capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        stderr = getattr(e, "stderr", None) or b""
+        logger.info("NVENC probe failed, encoding videos with libx264: %s", stderr.decode(errors="replace").strip() or e)
+        return False
+    logger.info("Encoding videos with h264_nvenc")
+    return True
+
+def _video_codec_args() -> List[str]:
+    """FFmpeg video encoder options, using NVENC when available and libx264 otherwise."""
+    if _nvenc_available():
+        return ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq", "-rc", "vbr", "-cq", "23"]
+    # Slideshow input is static, so x264 can use still-image tuning and every core for encode and filters
+    cpu_count = str(os.cpu_count() or 1)
+    return [
+        "-c:v", "libx264", "-preset", "veryfast", "-tune", "stillimage", "-threads", "0",
+        "-filter_threads", cpu_count, "-filter_complex_threads", cpu_count
+    ]
+
 def assemble_video(image_paths: List[str], audio_path: str, out_path: str = "output.mp4", duration: int = 60, music_path: str = None) -> str:
     """Combine images and audio into a video using FFmpeg."""
-    # Create video from images
-    img_pattern = os.path.join(os.path.dirname(image_paths[0]), "img_%d.png")
-    video_tmp = out_path.replace('.mp4', '_tmp.mp4')
+    if len(image_paths) == 1:
+        # A single still only needs to be looped for the length of the audio, capped at duration
+        ffmpeg_cmd = [
+            "ffmpeg", "-y", "-loop", "1", "-i", image_paths[0], "-i", audio_path,
+            *_video_codec_args(), "-pix_fmt", "yuv420p", "-c:a", "aac", "-t", str(duration), "-shortest", out_path
+        ]
+        subprocess.run(ffmpeg_cmd, check=True)
+        return out_path
+    # Encode images and mux audio in a single pass, without an intermediate video file.
+    # The concat demuxer gives each image an exact (fractional) on-screen duration.
+    img_dir = os.path.dirname(image_paths[0])
     img_count = len(image_paths)
-    img_duration = duration // img_count
-    ffmpeg_img_cmd = [
-        "ffmpeg", "-y", "-framerate", str(1/img_duration), "-i", img_pattern,
-        "-c:v", "libx264", "-r", "30", "-pix_fmt", "yuv420p", video_tmp
-    ]
-    subprocess.run(ffmpeg_img_cmd, check=True)
-    # Add audio
-    ffmpeg_audio_cmd = [
-        "ffmpeg", "-y", "-i", video_tmp, "-i", audio_path, "-c:v", "copy", "-c:a", "aac", "-shortest", out_path
+    img_duration = duration / img_count
+    concat_path = os.path.join(img_dir, "concat.txt")
+    with open(concat_path, "w") as f:
+        for img_path in image_paths:
+            f.write(f"file '{os.path.basename(img_path)}'\nduration {img_duration}\n")
+        # The last entry's duration is only honoured if the file is listed once more
+        f.write(f"file '{os.path.basename(image_paths[-1])}'\n")
+    ffmpeg_cmd = [
+        "ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", concat_path, "-i", audio_path,
+        "-vsync", "vfr", *_video_codec_args(), "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-shortest", out_path
     ]
-    subprocess.run(ffmpeg_audio_cmd, check=True)
+    try:
+        subprocess.run(ffmpeg_cmd, check=True)
+    finally:
+        # Job directories are served publicly, don't leave the concat list behind
+        os.remove(concat_path)
     # Optionally add background music (not implemented here)
-    os.remove(video_tmp)
     return out_path
 
 # --- Pipeline Orchestration ---
-def process_video_pipeline(
+# A sentence fragment, with its terminating punctuation if present
+_SENT_RE = re.compile(r'[^.!?\n]+[.!?]?')
+
+async def process_video_pipeline(
     text: str,
     template: str,
     voice_type: str,
     user_id: str,
     out_dir: str = "static/videos",
     duration: int = 60,
-    elevenlabs_api_key: str = None
+    elevenlabs_api_key: str = None,
+    quality: Literal["fast", "standard", "hq"] = "standard",
+    job_id: str = None
 ) -> dict:
     """Full pipeline: enhance text, generate images/audio, assemble video."""
-    job_id = str(uuid.uuid4())
+    loop = asyncio.get_running_loop()
+    if job_id is None:
+        job_id = str(uuid.uuid4())
     job_dir = os.path.join(out_dir, job_id)
     os.makedirs(job_dir, exist_ok=True)
     # 1. Enhance text
-    enhanced_text = enhance_text(text)
-    # 2. Extract prompts (simple split for now)
-    prompts = [f"{template} educational image: {line.strip()}" for line in enhanced_text.split('.') if line.strip()][:3]
-    # 3. Generate images
-    image_paths = generate_images(prompts, job_dir)
-    # 4. Generate audio
+    enhanced_text = await enhance_text_batched(text)
+    # 2. Extract prompts from the first few sentences
+    sentences = (m.group().strip() for m in _SENT_RE.finditer(enhanced_text))
+    prompts = [f"{template} educational image: {sentence}" for sentence in itertools.islice(filter(None, sentences), 3)]
+    # 3. Generate images and audio concurrently, they only depend on the enhanced text
     audio_path = os.path.join(job_dir, "audio.mp3")
-    generate_audio(enhanced_text, voice=voice_type, out_path=audio_path, api_key=elevenlabs_api_key)
-    # 5. Assemble video
+    img_task = loop.run_in_executor(_sd_executor, functools.partial(generate_images, prompts, job_dir, quality=quality))
+    audio_task = generate_audio_async(enhanced_text, voice=voice_type, out_path=audio_path, api_key=elevenlabs_api_key)
+    image_paths, _ = await asyncio.gather(img_task, audio_task)
+    # 4. Assemble video
     video_path = os.path.join(job_dir, "video.mp4")
-    assemble_video(image_paths, audio_path, out_path=video_path, duration=duration)
+    await loop.run_in_executor(
+        None, functools.partial(assemble_video, image_paths, audio_path, out_path=video_path, duration=duration)
+    )
     return {
         "job_id": job_id,
         "video_path": video_path,
@@ -1,23 +1,56 @@
 
+from sqlalchemy import select
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from . import models, schemas
+from typing import Optional
 
 def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
 
+def _insert(db: Session):
+    # ON CONFLICT is dialect specific, pick the insert construct matching the bound engine
+    if db.get_bind().dialect.name == "postgresql":
+        return pg_insert
+    return sqlite_insert
+
 def create_user(db: Session, user: schemas.UserCreate):
-    db_user = models.User(email=user.email)
-    db.add(db_user)
+    """Insert a user in a single statement; returns None if the email is already registered."""
+    stmt = (
+        _insert(db)(models.User)
+        .values(email=user.email)
+        .on_conflict_do_nothing(index_elements=["email"])
+        .returning(models.User)
+    )
+    db_user = db.scalars(stmt).one_or_none()
     db.commit()
-    db.refresh(db_user)
     return db_user
 
-def get_videos_by_user(db: Session, user_id: int, skip: int = 0, limit: int = 10):
-    return db.query(models.Video).filter(models.Video.user_id == user_id).offset(skip).limit(limit).all()
+def get_videos_by_user(db: Session, user_id: int, after_id: Optional[int] = None, limit: int = 10):
+    """Newest videos first, keyset-paginated on id so deep pages cost the same as the first."""
+    stmt = select(models.Video).where(models.Video.user_id == user_id).order_by(models.Video.id.desc()).limit(limit)
+    if after_id is not None:
+        stmt = stmt.where(models.Video.id < after_id)
+    return db.execute(stmt).scalars().all()
 
 def create_user_video(db: Session, video: schemas.VideoCreate, user_id: int):
-    db_video = models.Video(**video.dict(), user_id=user_id)
+    db_video = models.Video(**video.model_dump(), user_id=user_id)
     db.add(db_video)
     db.commit()
     db.refresh(db_video)
     return db_video
+
+def create_video_job(db: Session, job_id: str, user_id: str):
+    db_job = models.VideoJob(id=job_id, user_id=user_id)
+    db.add(db_job)
+    db.commit()
+    db.refresh(db_job)
+    return db_job
+
+def get_video_job(db: Session, job_id: str):
+    return db.get(models.VideoJob, job_id)
+
+def update_video_job(db: Session, job_id: str, **fields):
+    db.query(models.VideoJob).filter(models.VideoJob.id == job_id).update(fields)
+    db.commit()
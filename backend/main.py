@@ -1,21 +1,34 @@
 
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from sqlalchemy.orm import Session
 import time
 import asyncio
+import functools
+import logging
 
 
 from . import crud, models, schemas
 from .database import SessionLocal, engine
 from pydantic import BaseModel
-from .ai_pipeline import process_video_pipeline
+from .ai_pipeline import process_video_pipeline, warmup_text_model, warmup_sd_pipe, close_tts_client
 import os
+import uuid
+from typing import Literal, Optional
+
+logger = logging.getLogger(__name__)
+
+# ElevenLabs key comes from the environment, never from source
+elevenlabs_api_key = os.getenv("ELEVENLABS_API_KEY")
 
 models.Base.metadata.create_all(bind=engine)
+# create_all skips tables that already exist, so make sure newer indexes are present too
+for index in models.Video.__table__.indexes:
+    index.create(bind=engine, checkfirst=True)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # CORS Middleware
 app.add_middleware(
@@ -30,6 +43,16 @@ app.add_middleware(
 # Running `uvicorn main:app` from the `backend` directory means the path is `static/videos`.
 app.mount("/videos", StaticFiles(directory="static/videos"), name="videos")
 
+# Load the models once (and compile the UNet) so the first request doesn't pay for it
+@app.on_event("startup")
+def warm_models():
+    warmup_text_model()
+    warmup_sd_pipe()
+
+@app.on_event("shutdown")
+async def close_clients():
+    await close_tts_client()
+
 # Dependency
 def get_db():
     db = SessionLocal()
@@ -40,15 +63,16 @@ def get_db():
 
 @app.post("/users/", response_model=schemas.User)
 def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
-    if db_user:
+    db_user = crud.create_user(db=db, user=user)
+    if db_user is None:
         raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user)
+    return db_user
 
-@app.get("/users/{user_id}/videos", response_model=list[schemas.Video])
-def read_user_videos(user_id: int, skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
-    videos = crud.get_videos_by_user(db, user_id=user_id, skip=skip, limit=limit)
-    return videos
+@app.get("/users/{user_id}/videos", response_model=schemas.VideoPage)
+def read_user_videos(user_id: int, after_id: Optional[int] = None, limit: int = Query(10, ge=1, le=100), db: Session = Depends(get_db)):
+    videos = crud.get_videos_by_user(db, user_id=user_id, after_id=after_id, limit=limit)
+    next_cursor = videos[-1].id if len(videos) == limit else None
+    return {"items": videos, "next_cursor": next_cursor}
 
 
 # Request schema for video generation
@@ -57,26 +81,51 @@ class GenerateVideoRequest(BaseModel):
     template: str
     voice_type: str
     user_id: str
+    quality: Literal["fast", "standard", "hq"] = "standard"
+
+def _update_job(job_id: str, **fields):
+    db = SessionLocal()
+    try:
+        crud.update_video_job(db, job_id, **fields)
+    finally:
+        db.close()
+
+async def _run_pipeline(job_id: str, req: GenerateVideoRequest, out_dir: str):
+    """Run the video pipeline for a queued job and record its outcome."""
+    loop = asyncio.get_running_loop()
+    # Job status writes are blocking DB calls, keep them off the event loop
+    await loop.run_in_executor(None, functools.partial(_update_job, job_id, status="processing"))
+    try:
+        result = await process_video_pipeline(
+            text=req.text,
+            template=req.template,
+            voice_type=req.voice_type,
+            user_id=req.user_id,
+            out_dir=out_dir,
+            duration=60,
+            elevenlabs_api_key=elevenlabs_api_key,
+            quality=req.quality,
+            job_id=job_id
+        )
+    except Exception as e:
+        logger.exception("Video job %s failed", job_id)
+        await loop.run_in_executor(None, functools.partial(_update_job, job_id, status="failed", error=str(e)))
+        return
+    video_url = "/videos/" + os.path.relpath(result["video_path"], out_dir).replace(os.sep, "/")
+    await loop.run_in_executor(None, functools.partial(_update_job, job_id, status="completed", video_url=video_url))
 
 @app.post("/generate-video")
-async def generate_video(req: GenerateVideoRequest):
-    """Endpoint to generate educational video from text input."""
+def generate_video(req: GenerateVideoRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    """Endpoint to queue generation of an educational video from text input."""
     out_dir = os.path.join("static", "videos")
-    elevenlabs_api_key = "sk_ba0a244e846b46b2cfd76474afca7e11c5b54b5048686167"
-    result = process_video_pipeline(
-        text=req.text,
-        template=req.template,
-        voice_type=req.voice_type,
-        user_id=req.user_id,
-        out_dir=out_dir,
-        duration=60,
-        elevenlabs_api_key=elevenlabs_api_key
-    )
-    return result
+    job_id = str(uuid.uuid4())
+    crud.create_video_job(db, job_id=job_id, user_id=req.user_id)
+    background_tasks.add_task(_run_pipeline, job_id, req, out_dir)
+    return {"job_id": job_id, "status": "queued"}
 
 @app.get("/video-status/{video_id}")
-async def get_video_status(video_id: str):
-    # In a real app, you would fetch this from the database
-    # For this mock, we'll just return a completed status
-    return {"video_id": video_id, "status": "completed", "video_url": "/videos/sample.mp4"}
-
+def get_video_status(video_id: str, db: Session = Depends(get_db)):
+    job = crud.get_video_job(db, job_id=video_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Video job not found")
+    return {"video_id": job.id, "status": job.status, "video_url": job.video_url, "error": job.error}
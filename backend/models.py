@@ -1,14 +1,15 @@
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from .database import Base
 import datetime
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (Index("ix_users_email", "email", unique=True),)
 
     id = Column(Integer, primary_key=True, index=True)
-    email = Column(String, unique=True, index=True, nullable=False)
+    email = Column(String, nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     video_quota = Column(Integer, default=10)
 
@@ -16,6 +17,7 @@ class User(Base):
 
 class Video(Base):
     __tablename__ = "videos"
+    __table_args__ = (Index("ix_videos_user_id_id", "user_id", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -27,3 +29,13 @@ class Video(Base):
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
     owner = relationship("User", back_populates="videos")
+
+class VideoJob(Base):
+    __tablename__ = "video_jobs"
+
+    id = Column(String, primary_key=True, index=True)
+    user_id = Column(String)
+    status = Column(String, default="queued")
+    video_url = Column(String)
+    error = Column(String)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
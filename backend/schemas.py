@@ -1,5 +1,5 @@
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 import datetime
 from typing import List, Optional
 
@@ -18,8 +18,11 @@ class Video(VideoBase):
     status: str
     created_at: datetime.datetime
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+class VideoPage(BaseModel):
+    items: List[Video]
+    next_cursor: Optional[int] = None
 
 class UserBase(BaseModel):
     email: str
@@ -32,5 +35,4 @@ class User(UserBase):
     video_quota: int
     videos: List[Video] = []
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)